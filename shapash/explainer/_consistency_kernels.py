@@ -0,0 +1,111 @@
+"""
+Numerical kernels used to compute the consistency between contributions
+"""
+import math
+
+import numpy as np
+from numba import njit, prange
+
+# Minimum number of contributions values (instances x features) from which
+# the compiled kernel is faster than the NumPy implementation
+NUMBA_MIN_SIZE = 1e6
+
+
+def row_l2_norm(weights):
+    """
+    Compute the L2 norm of each row of a 2D array with a single einsum reduction
+
+    Parameters
+    ----------
+    weights : array
+        Contributions of shape (n, d)
+
+    Returns
+    -------
+    array
+        L2 norm of each row, of shape (n,)
+    """
+    return np.sqrt(np.einsum("ij,ij->i", weights, weights))
+
+
+def normalize_rows(weights):
+    """
+    Divide each row of a 2D array by its L2 norm. Rows with a null norm are filled with NaN.
+
+    Parameters
+    ----------
+    weights : array-like
+        Contributions of shape (n, d)
+
+    Returns
+    -------
+    array
+        Normalized contributions, of shape (n, d)
+    """
+    weights = np.asarray(weights)
+    norms = row_l2_norm(weights)[:, np.newaxis]
+    out = np.full(weights.shape, np.nan, dtype=norms.dtype)
+    return np.divide(weights, norms, out=out, where=norms > 0)
+
+
+def mds_2d(distances):
+    """
+    Compute 2D coordinates of points with classical (Torgerson) MDS: the coordinates are
+    the top 2 eigenvectors of the double-centered squared distances, scaled by the square
+    root of their eigenvalues. Distances are exactly preserved when points can be embedded
+    in 2D (e.g. 3 points).
+
+    Parameters
+    ----------
+    distances : array
+        Symmetric matrix of distances between points, of shape (m, m)
+
+    Returns
+    -------
+    array
+        Coordinates of each point, of shape (m, 2)
+    """
+    num_points = distances.shape[0]
+    centering = np.eye(num_points) - np.ones((num_points, num_points)) / num_points
+    gram = -0.5 * centering @ np.square(distances) @ centering
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    return eigenvectors[:, :-3:-1] * np.sqrt(np.maximum(eigenvalues[:-3:-1], 0))
+
+
+@njit(parallel=True, fastmath={"reassoc", "contract", "arcp"}, cache=True)
+def _row_l2_distance(norm_weights_i, norm_weights_j, out):
+    """
+    Fill out with the L2 norm of the difference between each row of 2 arrays,
+    processing rows in parallel. NaN rows give a NaN distance.
+    """
+    for k in prange(norm_weights_i.shape[0]):
+        sq_dist = 0.0
+        for t in range(norm_weights_i.shape[1]):
+            diff = norm_weights_i[k, t] - norm_weights_j[k, t]
+            sq_dist += diff * diff
+        out[k] = math.sqrt(sq_dist)
+
+
+def row_l2_distance(norm_weights_i, norm_weights_j):
+    """
+    For each instance, compute the L2 norm of the difference between the normalized
+    contributions of 2 methods. Large inputs are processed by a compiled kernel,
+    which avoids allocating the difference.
+
+    Parameters
+    ----------
+    norm_weights_i : array
+        Normalized contributions of method 1, of shape (n, d)
+    norm_weights_j : array
+        Normalized contributions of method 2, of shape (n, d)
+
+    Returns
+    -------
+    array
+        Distance of each instance, of shape (n,)
+    """
+    if norm_weights_i.size > NUMBA_MIN_SIZE:
+        out = np.empty(norm_weights_i.shape[0])
+        _row_l2_distance(norm_weights_i, norm_weights_j, out)
+        return out
+    return row_l2_norm(norm_weights_i - norm_weights_j)
@@ -1,15 +1,14 @@
 from category_encoders import OrdinalEncoder
 import copy
-import itertools
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from plotly import graph_objs as go
 from plotly.offline import plot
 from plotly.subplots import make_subplots
-from sklearn.manifold import MDS
 
 from shapash import SmartExplainer
+from shapash.explainer._consistency_kernels import mds_2d, normalize_rows, row_l2_distance
 from shapash.style.style_utils import colors_loading, select_palette, define_style
 
 
@@ -132,16 +131,21 @@ class Consistency():
         """
         if weights[0].ndim == 1:
             raise ValueError('Multiple datapoints are required to compute the metric')
-        if not all(isinstance(x, pd.DataFrame) for x in weights):
-            raise ValueError('Contributions must be pandas DataFrames')
-        if not all(x.shape == weights[0].shape for x in weights):
-            raise ValueError('Contributions must be of same shape')
-        if not all(x.columns.tolist() == weights[0].columns.tolist() for x in weights):
-            raise ValueError('Columns names are different between contributions')
-        if not all(x.index.tolist() == weights[0].index.tolist() for x in weights):
-            raise ValueError('Index names are different between contributions')
-
-    def consistency_plot(self, selection=None, max_features=20):
+        reference = None
+        for x in weights:
+            if not isinstance(x, pd.DataFrame):
+                raise ValueError('Contributions must be pandas DataFrames')
+            if reference is None:
+                reference = x
+                continue
+            if x.shape != reference.shape:
+                raise ValueError('Contributions must be of same shape')
+            if not x.columns.equals(reference.columns):
+                raise ValueError('Columns names are different between contributions')
+            if not x.index.equals(reference.index):
+                raise ValueError('Index names are different between contributions')
+
+    def consistency_plot(self, selection=None, max_features=20, dtype=np.float64):
         """
         The Consistency_plot has the main objective of comparing explainability methods.
 
@@ -154,6 +158,9 @@ class Consistency():
         we would be more confident in using those methods.
         If not, careful conideration should be taken in the interpretation of the explanations
 
+        Contributions are converted to C-contiguous arrays of the given dtype before computing
+        distances, so that NumPy can use its vectorized kernels.
+
         Parameters
         ----------
         selection: list
@@ -161,6 +168,10 @@ class Consistency():
             for the compute of consitency statistics, by default None
         max_features: int, optional
             Maximum number of displayed features, by default 20
+        dtype: numpy dtype, optional
+            Floating type used to compute distances, by default np.float64.
+            np.float32 halves the memory traffic at the cost of precision on very close
+            contributions
         """
         # Selection
         if selection is None:
@@ -172,6 +183,7 @@ class Consistency():
                 weights = [weight.values[selection] for weight in self.weights]
         else:
             raise ValueError('Parameter selection must be a list')
+        weights = [np.ascontiguousarray(weight, dtype=dtype) for weight in weights]
 
         all_comparisons, mean_distances = self.calculate_all_distances(self.methods, weights)
 
@@ -195,28 +207,46 @@ class Consistency():
 
         Returns
         -------
-        all_comparisons : array
+        all_comparisons : float64 array
             Array containing, for each instance and each pair of methods, the distance between the contribtuions
         mean_distances : DataFrame
             DataFrame storing all pairwise distances between methods
         """
-        mean_distances = pd.DataFrame(np.zeros((len(methods), len(methods))), columns=methods, index=methods)
+        num_instances = np.shape(weights[0])[0]
 
-        # Initialize a (n choose 2)x4 array (n=num of instances)
-        # that will contain : indices of methods that are compared, index of instance, L2 value of instance
-        all_comparisons = np.array([np.repeat(None, 4)])
+        # Indices of all pairs of methods, in the same order as itertools.combinations
+        index_i, index_j = np.triu_indices(len(methods), k=1)
+        num_pairs = len(index_i)
 
-        for index_i, index_j in itertools.combinations(range(len(methods)), 2):
-            l2_dist = self.calculate_pairwise_distances(weights, index_i, index_j)
-            # Populate the (n choose 2)x4 array
-            pairwise_comparison = np.column_stack(
-                (np.repeat(index_i, len(l2_dist)), np.repeat(index_j, len(l2_dist)), np.arange(len(l2_dist)), l2_dist,)
-            )
-            all_comparisons = np.concatenate((all_comparisons, pairwise_comparison), axis=0)
-
-            self.calculate_mean_distances(methods, mean_distances, index_i, index_j, l2_dist)
-
-        all_comparisons = all_comparisons[1:, :]
+        # (P, n) array of the L2 norm of the differences of normalized weights
+        # (P=num of pairs of methods)
+        if len(methods) == 2:
+            # Only one pair of methods to compare
+            l2_dist = self.calculate_pairwise_distances(weights, 0, 1)[np.newaxis, :]
+        else:
+            # Normalize the weights of each method only once using L2 norm
+            norm_weights = [normalize_rows(weight) for weight in weights]
+            l2_dist = np.empty((num_pairs, num_instances))
+            for pair, (i, j) in enumerate(zip(index_i, index_j)):
+                l2_dist[pair] = row_l2_distance(norm_weights[i], norm_weights[j])
+
+        # Preallocate a (P x n)x4 array that will contain :
+        # indices of methods that are compared, index of instance, L2 value of instance
+        all_comparisons = np.empty((num_pairs, num_instances, 4), dtype=np.float64)
+        # Indices of methods are broadcast over the instances of each pair,
+        # and indices of instances are shared by all pairs
+        all_comparisons[:, :, 0] = index_i[:, np.newaxis]
+        all_comparisons[:, :, 1] = index_j[:, np.newaxis]
+        all_comparisons[:, :, 2] = np.arange(num_instances)
+        all_comparisons[:, :, 3] = l2_dist
+        all_comparisons = all_comparisons.reshape(-1, 4)
+
+        # Calculate mean distance between each pair of methods, written once in both triangles
+        pair_distances = l2_dist.mean(axis=1)
+        mean_distances = np.zeros((len(methods), len(methods)))
+        mean_distances[index_i, index_j] = pair_distances
+        mean_distances[index_j, index_i] = pair_distances
+        mean_distances = pd.DataFrame(mean_distances, columns=methods, index=methods)
 
         return all_comparisons, mean_distances
 
@@ -238,35 +268,15 @@ class Consistency():
         l2_dist : array
             Distance between the two selected methods for all instances
         """
-        # Normalize weights using L2 norm
-        norm_weights_i = weights[index_i] / np.linalg.norm(weights[index_i], ord=2, axis=1)[:, np.newaxis]
-        norm_weights_j = weights[index_j] / np.linalg.norm(weights[index_j], ord=2, axis=1)[:, np.newaxis]
-        # And then take the L2 norm of the difference as a metric
-        l2_dist = np.linalg.norm(norm_weights_i - norm_weights_j, ord=2, axis=1)
+        # Normalize weights using L2 norm, and then take the L2 norm of the difference as a metric.
+        # The difference is computed directly: the 2 - 2 * cos identity loses precision
+        # on close contributions
+        norm_weights_i = normalize_rows(weights[index_i])
+        norm_weights_j = normalize_rows(weights[index_j])
+        l2_dist = row_l2_distance(norm_weights_i, norm_weights_j)
 
         return l2_dist
 
-    def calculate_mean_distances(self, methods, mean_distances, index_i, index_j, l2_dist):
-        """
-        Given the contributions of all instances for two selected instances, calculate the distance between them
-
-        Parameters
-        ----------
-        methods : list
-            List of methods used in the calculation of contributions
-        mean_distances : DataFrame
-            DataFrame storing all pairwise distances between methods
-        index_i : int
-            Index of method 1
-        index_j : int
-            Index of method 2
-        l2_dist : array
-            Distance between the two selected methods for all instances
-        """
-        # Calculate mean distance between the two methods and update the matrix
-        mean_distances.loc[methods[index_i], methods[index_j]] = np.mean(l2_dist)
-        mean_distances.loc[methods[index_j], methods[index_i]] = np.mean(l2_dist)
-
     def find_examples(self, mean_distances, all_comparisons, weights):
         """
         To illustrate the meaning of distances between methods, extract 5 real examples from the dataset
@@ -295,36 +305,46 @@ class Consistency():
         backend_name_2 : list
             Name of the explainability method displayed on the right
         """
-        method_1 = []
-        backend_name_1 = []
-        method_2 = []
-        backend_name_2 = []
-        index = []
-        l2 = []
+        # Sort the L2 distances once to find the closest ones with a binary search
+        l2_dist = all_comparisons[:, -1]
+        order = np.argsort(l2_dist, kind="stable")
+        sorted_l2_dist = l2_dist[order]
 
         # Evenly split the scale of L2 distances (from min to max excluding 0)
-        for i in np.linspace(start=mean_distances[mean_distances > 0].min().min(), stop=mean_distances.max().max(), num=5):
-            # For each split, find the closest existing L2 distance
-            closest_l2 = all_comparisons[:, -1][np.abs(all_comparisons[:, -1] - i).argmin()]
-            # Return the row that contains this L2 distance
-            row = all_comparisons[all_comparisons[:, -1] == closest_l2]
-            # Extract corresponding SHAP Values
-            contrib_1 = weights[int(row[0, 0])][int(row[0, 2])]
-            contrib_2 = weights[int(row[0, 1])][int(row[0, 2])]
-            # Extract method names
-            method_name_1 = self.methods[int(row[0, 0])]
-            method_name_2 = self.methods[int(row[0, 1])]
-            # Extract index of the selected example
-            index_example = self.index[int(row[0, 2])]
-            # Prevent from displaying duplicate examples
-            if closest_l2 in l2:
-                continue
-            method_1.append(contrib_1 / np.linalg.norm(contrib_1, ord=2))
-            method_2.append(contrib_2 / np.linalg.norm(contrib_2, ord=2))
-            l2.append(closest_l2)
-            index.append(index_example)
-            backend_name_1.append(method_name_1)
-            backend_name_2.append(method_name_2)
+        pair_distances = mean_distances.values[np.triu_indices(mean_distances.shape[0], k=1)]
+        max_distance = pair_distances.max()
+        min_distance = pair_distances[pair_distances > 0].min(initial=max_distance)
+        splits = np.linspace(start=min_distance, stop=max_distance, num=5)
+        # For each split, find the closest existing L2 distance
+        pos = np.clip(np.searchsorted(sorted_l2_dist, splits), 1, len(sorted_l2_dist) - 1)
+        # First occurrence of both neighbours, i.e. their first row in all_comparisons
+        left = np.searchsorted(sorted_l2_dist, sorted_l2_dist[pos - 1])
+        right = np.searchsorted(sorted_l2_dist, sorted_l2_dist[pos])
+        left_gap = np.abs(sorted_l2_dist[left] - splits)
+        right_gap = np.abs(sorted_l2_dist[right] - splits)
+        # When both neighbours are equally close, keep the first row as argmin would
+        first_left = order[left] < order[right]
+        pick_left = (left_gap < right_gap) | ((left_gap == right_gap) & first_left)
+        pos = np.where(pick_left, left, right)
+        # Prevent from displaying duplicate examples
+        _, first_occurrence_idx = np.unique(sorted_l2_dist[pos], return_index=True)
+        pos = pos[np.sort(first_occurrence_idx)]
+        closest_l2 = sorted_l2_dist[pos]
+        rows = all_comparisons[order[pos]]
+        # Indices of methods and instances are stored as floats: cast them once
+        index_i, index_j, index_instance = rows[:, :3].astype(np.intp).T
+
+        # Extract corresponding SHAP Values and normalize all of them at once
+        contribs_1 = np.stack([weights[i][k] for i, k in zip(index_i, index_instance)])
+        contribs_2 = np.stack([weights[j][k] for j, k in zip(index_j, index_instance)])
+        method_1 = list(normalize_rows(contribs_1))
+        method_2 = list(normalize_rows(contribs_2))
+        l2 = list(closest_l2)
+        # Extract index of the selected examples
+        index = list(self.index[index_instance])
+        # Extract method names
+        backend_name_1 = [self.methods[i] for i in index_i]
+        backend_name_2 = [self.methods[j] for j in index_j]
 
         return method_1, method_2, l2, index, backend_name_1, backend_name_2
 
@@ -341,7 +361,16 @@ class Consistency():
         -------
         Coordinates of each method
         """
-        return MDS(n_components=2, dissimilarity="precomputed", random_state=0).fit_transform(mean_distances)
+        # With only 2 methods, place them on the x-axis without running MDS
+        if mean_distances.shape == (2, 2):
+            return np.array([[0, 0], [mean_distances.iat[0, 1], 0]])
+        # Iterative MDS is only worth it for a large number of methods
+        if mean_distances.shape[0] > 20:
+            from sklearn.manifold import MDS
+            mds = MDS(n_components=2, dissimilarity="precomputed", random_state=0)
+            return mds.fit_transform(mean_distances)
+        # Otherwise use deterministic classical MDS, computed in closed form
+        return mds_2d(mean_distances.values)
 
     def plot_comparison(self, mean_distances):
         """
@@ -448,26 +477,38 @@ class Consistency():
         -------
         figure
         """
-        y = np.arange(method_1[0].shape[0])
+        method_1, method_2 = np.stack(method_1), np.stack(method_2)
+        # Only keep top features according to both methods. Features are ranked by their largest
+        # absolute contribution; ties go to the one whose largest contribution comes last when
+        # concatenating method_1 and method_2, as when sorting this concatenation
+        abs_1, abs_2 = np.abs(method_1), np.abs(method_2)
+        features = np.arange(method_1.shape[1])
+        position = np.where(abs_2 >= abs_1, features + method_1.shape[1], features)
+        idx = np.flip(np.lexsort((position, np.maximum(abs_1, abs_2)), axis=1), axis=1)
+        idx = idx[:, :max_features]
+        method_1 = np.take_along_axis(method_1, idx, axis=1)
+        method_2 = np.take_along_axis(method_2, idx, axis=1)
+        # Sort by method_1 (no abs)
+        idx = np.flip(np.argsort(method_1, axis=1, kind="stable"), axis=1)
+        method_1 = np.take_along_axis(method_1, idx, axis=1)
+        method_2 = np.take_along_axis(method_2, idx, axis=1)
+        # Position of the bars of method 2 (/3 to add space)
+        max_1 = method_1.max(axis=1)
+        offsets = np.abs(max_1) + np.abs(method_2.min(axis=1)) + max_1 / 3
+
+        y = np.arange(method_1.shape[1])
         fig, axes = plt.subplots(ncols=len(l2), figsize=(3*len(l2), 4))
         fig.subplots_adjust(wspace=.3, top=.8)
         if len(l2) == 1:
             axes = np.array([axes])
         fig.suptitle("Examples of explanations' comparisons for various distances (L2 norm)")
 
-        for n, (i, j, k, l, m, o) in enumerate(zip(method_1, method_2, l2, index, backend_name_1, backend_name_2)):
-            # Only keep top features according to both methods
-            idx = np.flip(np.abs(np.concatenate([i, j])).argsort()) % len(i)
-            _, first_occurrence_idx = np.unique(idx, return_index=True)
-            idx, y = idx[np.sort(first_occurrence_idx)][:max_features], y[:max_features]
-            i, j = i[idx], j[idx]
-            # Sort by method_1 (no abs)
-            idx = np.flip(i.argsort())
-            i, j = i[idx], j[idx]
-
-            axes[n].barh(y, i, label='method 1', left=0, color='#{:02x}{:02x}{:02x}'.format(255, 166, 17))
-            axes[n].barh(y, j, label='method 2', left=np.abs(np.max(i)) + np.abs(np.min(j)) + np.max(i)/3,
-                         color='#{:02x}{:02x}{:02x}'.format(117, 152, 189))  # /3 to add space
+        for n, (i, j, offset, k, l, m, o) in enumerate(zip(method_1, method_2, offsets, l2, index,
+                                                            backend_name_1, backend_name_2)):
+            axes[n].barh(y, i, label='method 1', left=0,
+                         color='#{:02x}{:02x}{:02x}'.format(255, 166, 17))
+            axes[n].barh(y, j, label='method 2', left=offset,
+                         color='#{:02x}{:02x}{:02x}'.format(117, 152, 189))
 
             # set gray background
             axes[n].set_facecolor('#F5F5F2')
@@ -478,7 +519,7 @@ class Consistency():
                         (self.index.name if self.index.name is not None else "Id", l) + "\n$d_{L2}$ = " + str(round(k, 2)))
             axes[n].set_xlabel("Contributions")
             axes[n].set_ylabel(f"Top {max_features} features")
-            axes[n].set_xticks([0, np.abs(np.max(i)) + np.abs(np.min(j)) + np.max(i)/3])
+            axes[n].set_xticks([0, offset])
             axes[n].set_xticklabels([m, o])
             axes[n].set_yticks([])
 
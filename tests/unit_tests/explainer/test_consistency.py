@@ -1,8 +1,11 @@
 import itertools
 import numpy as np
 import pandas as pd
+from scipy.spatial.distance import pdist, squareform
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.manifold import MDS
 import unittest
+from unittest.mock import patch
 from shapash.explainer.consistency import Consistency
 
 
@@ -85,6 +88,36 @@ class TestConsistency(unittest.TestCase):
         if not all(x.index.tolist() == weights[0].index.tolist() for x in weights):
             raise ValueError('Index names are different between contributions')
 
+    def test_check_consistency_contributions_errors(self):
+        self.cns.check_consistency_contributions([self.w1, self.w2, self.w3])
+
+        with self.assertRaises(ValueError):
+            self.cns.check_consistency_contributions([self.w1, self.w2.values])
+        with self.assertRaises(ValueError):
+            self.cns.check_consistency_contributions([self.w1, self.w2.iloc[:2]])
+        with self.assertRaises(ValueError):
+            self.cns.check_consistency_contributions(
+                [self.w1, self.w2.rename(columns={'X1': 'X4'})])
+        with self.assertRaises(ValueError):
+            self.cns.check_consistency_contributions(
+                [self.w1, self.w2.set_index(self.w2.index + 1)])
+
+    def test_consistency_plot(self):
+        cns = Consistency()
+        cns.compile(contributions={"shap": self.w1, "acv": self.w2})
+
+        for consistency in [cns, self.cns]:
+            weights = [weight.values for weight in consistency.weights]
+            _, expected = consistency.calculate_all_distances(consistency.methods, weights)
+            for dtype in [np.float64, np.float32]:
+                with patch.object(Consistency, "plot_comparison", autospec=True,
+                                  side_effect=Consistency.plot_comparison) as plot_comparison:
+                    consistency.consistency_plot(max_features=2, dtype=dtype)
+
+                mean_distances = plot_comparison.call_args[0][1]
+                assert mean_distances.values.dtype == np.float64
+                np.testing.assert_allclose(mean_distances, expected, rtol=1e-5)
+
     def test_calculate_all_distances(self):
         all_comparisons, mean_distances = self.cns.calculate_all_distances(self.cns.methods, self.cns.weights)
 
@@ -94,20 +127,76 @@ class TestConsistency(unittest.TestCase):
         assert isinstance(mean_distances, pd.DataFrame)
         assert mean_distances.shape == (len(self.cns.methods), len(self.cns.methods))
 
+        for index_i, index_j in itertools.combinations(range(len(self.cns.methods)), 2):
+            l2_dist = self.cns.calculate_pairwise_distances(self.cns.weights, index_i, index_j)
+            rows = (all_comparisons[:, 0] == index_i) & (all_comparisons[:, 1] == index_j)
+            np.testing.assert_allclose(all_comparisons[rows, -1], l2_dist)
+            np.testing.assert_allclose(mean_distances.iloc[index_i, index_j], l2_dist.mean())
+            np.testing.assert_allclose(mean_distances.iloc[index_j, index_i], l2_dist.mean())
+
     def test_calculate_pairwise_distances(self):
         l2_dist = self.cns.calculate_pairwise_distances(self.cns.weights, 0, 1)
 
         assert l2_dist.shape == (self.X.shape[0], )
 
-    def test_calculate_mean_distances(self):
-        _, mean_distances = self.cns.calculate_all_distances(self.cns.methods, self.cns.weights)
-        l2_dist = self.cns.calculate_pairwise_distances(self.cns.weights, 0, 1)
+    def test_calculate_pairwise_distances_numba(self):
+        # Add an identical row, a nearly identical row and a null row
+        # to the contributions of each method
+        extra_rows = np.array([[0.30, 0.20, 0.10],
+                               [0.30, 0.20, 0.10],
+                               [0.00, 0.00, 0.00]])
+        weights = [np.vstack([w.values, extra_rows + [[0, 0, 0], [i * 1e-6, 0, 0], [0, 0, 0]]])
+                   for i, w in enumerate([self.w1, self.w2, self.w3])]
+        l2_dist = self.cns.calculate_pairwise_distances(weights, 0, 1)
+        all_comparisons, mean_distances = \
+            self.cns.calculate_all_distances(["shap", "acv", "lime"], weights)
 
-        self.cns.calculate_mean_distances(self.cns.methods, mean_distances, 0, 1, l2_dist)
+        with patch("shapash.explainer._consistency_kernels.NUMBA_MIN_SIZE", 0):
+            l2_dist_numba = self.cns.calculate_pairwise_distances(weights, 0, 1)
+            all_comparisons_numba, mean_distances_numba = \
+                self.cns.calculate_all_distances(["shap", "acv", "lime"], weights)
 
-        assert mean_distances.shape == (len(self.cns.methods), len(self.cns.methods))
-        assert mean_distances.loc[self.cns.methods[0], self.cns.methods[1]] == \
-            mean_distances.loc[self.cns.methods[1], self.cns.methods[0]]
+        np.testing.assert_allclose(l2_dist_numba, l2_dist, atol=1e-12)
+        np.testing.assert_allclose(all_comparisons_numba, all_comparisons, atol=1e-12)
+        np.testing.assert_allclose(mean_distances_numba, mean_distances)
+        near_rows = [w[-2] / np.linalg.norm(w[-2]) for w in weights[:2]]
+        np.testing.assert_allclose(l2_dist[-3], 0, atol=1e-12)
+        np.testing.assert_allclose(l2_dist[-2], np.linalg.norm(near_rows[0] - near_rows[1]),
+                                   rtol=1e-6)
+        assert np.isnan(l2_dist[-1]) and np.isnan(l2_dist_numba[-1])
+
+    def test_calculate_distances_precision(self):
+        rng = np.random.default_rng(0)
+        w1 = rng.normal(size=(50, 20))
+        w2 = w1 + 1e-4 * rng.normal(size=w1.shape)
+        w3 = w1.copy()
+        for w in (w1, w2, w3):
+            w[0] = 0
+
+        def exact_distances(a, b):
+            with np.errstate(invalid='ignore'):
+                return np.linalg.norm(a / np.linalg.norm(a, axis=1, keepdims=True)
+                                      - b / np.linalg.norm(b, axis=1, keepdims=True), axis=1)
+
+        for dtype, rtol, atol in [(np.float64, 1e-6, 1e-12), (np.float32, 1e-2, 1e-6)]:
+            weights = [w.astype(dtype) for w in (w1, w2, w3)]
+            for numba_min_size in [1e12, 0]:
+                with patch("shapash.explainer._consistency_kernels.NUMBA_MIN_SIZE", numba_min_size):
+                    l2_dist = self.cns.calculate_pairwise_distances(weights, 0, 1)
+                    all_comparisons, _ = \
+                        self.cns.calculate_all_distances(["shap", "acv", "lime"], weights)
+
+                np.testing.assert_allclose(l2_dist, exact_distances(w1, w2), rtol=rtol, atol=atol)
+                for index_i, index_j in itertools.combinations(range(3), 2):
+                    rows = (all_comparisons[:, 0] == index_i) & (all_comparisons[:, 1] == index_j)
+                    np.testing.assert_allclose(all_comparisons[rows, -1],
+                                               exact_distances(weights[index_i].astype(np.float64),
+                                                               weights[index_j].astype(np.float64)),
+                                               rtol=rtol, atol=atol)
+                assert np.isnan(l2_dist[0])
+                # Identical contributions are at a null distance
+                rows = (all_comparisons[:, 0] == 0) & (all_comparisons[:, 1] == 2)
+                np.testing.assert_allclose(all_comparisons[rows, -1][1:], 0, atol=atol)
 
     def test_find_examples(self):
         weights = [weight.values for weight in self.cns.weights]
@@ -120,12 +209,127 @@ class TestConsistency(unittest.TestCase):
         assert len(method_1) == len(method_2) == len(l2)
         assert 1 <= len(l2) <= 5
 
+    def test_find_examples_argmin(self):
+        def brute_force(mean_distances, all_comparisons):
+            rows, l2 = [], []
+            for split in np.linspace(start=mean_distances[mean_distances > 0].min().min(),
+                                     stop=mean_distances.max().max(), num=5):
+                closest_l2 = all_comparisons[:, -1][np.abs(all_comparisons[:, -1] - split).argmin()]
+                if closest_l2 in l2:
+                    continue
+                l2.append(closest_l2)
+                rows.append(all_comparisons[all_comparisons[:, -1] == closest_l2][0])
+            return np.array(rows).astype(int), l2
+
+        rng = np.random.default_rng(5)
+        # With 2 instances, mean distances are midpoints of instance distances: splits tie
+        ties = [rng.normal(size=(2, 3)) for _ in range(4)]
+        duplicated = rng.normal(size=(10, 3))
+        for num_methods, contribs in [(4, ties),
+                                      (3, [rng.normal(size=(50, 4)) for _ in range(3)]),
+                                      (3, [duplicated, np.tile(duplicated[:5], (2, 1)),
+                                           rng.normal(size=(10, 3))])]:
+            methods = [f"method_{i}" for i in range(num_methods)]
+            index = pd.Index(np.arange(len(contribs[0])) + 100, name="id")
+            cns = Consistency()
+            cns.compile(contributions={m: pd.DataFrame(c, index=index)
+                                       for m, c in zip(methods, contribs)})
+            all_comparisons, mean_distances = cns.calculate_all_distances(methods, contribs)
+            method_1, method_2, l2, index_examples, backend_name_1, backend_name_2 = \
+                cns.find_examples(mean_distances, all_comparisons, contribs)
+
+            rows, expected_l2 = brute_force(mean_distances, all_comparisons)
+            assert l2 == expected_l2
+            assert len(set(l2)) == len(l2)
+            assert index_examples == list(index[rows[:, 2]])
+            assert backend_name_1 == [methods[i] for i in rows[:, 0]]
+            assert backend_name_2 == [methods[j] for j in rows[:, 1]]
+            for i, j, k, contrib_1, contrib_2 in zip(*rows[:, :3].T, method_1, method_2):
+                expected_1, expected_2 = contribs[i][k], contribs[j][k]
+                np.testing.assert_allclose(contrib_1, expected_1 / np.linalg.norm(expected_1))
+                np.testing.assert_allclose(contrib_2, expected_2 / np.linalg.norm(expected_2))
+
     def test_calculate_coords(self):
         _, mean_distances = self.cns.calculate_all_distances(self.cns.methods, self.cns.weights)
         coords = self.cns.calculate_coords(mean_distances)
 
         assert coords.shape == (len(self.cns.methods), 2)
 
+    def test_calculate_coords_2_methods(self):
+        _, mean_distances = self.cns.calculate_all_distances(["shap", "acv"], [self.w1, self.w2])
+        coords = self.cns.calculate_coords(mean_distances)
+
+        assert coords.shape == (2, 2)
+        np.testing.assert_allclose(np.linalg.norm(coords[0] - coords[1]), mean_distances.iloc[0, 1])
+
+    def test_calculate_coords_3_methods(self):
+        _, mean_distances = self.cns.calculate_all_distances(["shap", "acv", "lime"],
+                                                             [self.w1, self.w2, self.w3])
+        coords = self.cns.calculate_coords(mean_distances)
+
+        # 3 points can always be embedded in 2D: distances are exactly preserved
+        np.testing.assert_allclose(pdist(coords), squareform(mean_distances.values, checks=False))
+
+    def test_calculate_coords_many_methods(self):
+        rng = np.random.default_rng(0)
+        for num_methods in [4, 5, 6]:
+            points = rng.normal(size=(num_methods, 2))
+            methods = [str(i) for i in range(num_methods)]
+            mean_distances = pd.DataFrame(squareform(pdist(points)), columns=methods, index=methods)
+            coords = self.cns.calculate_coords(mean_distances)
+
+            # Points lying in a plane are recovered up to an isometry, centered on the origin
+            assert coords.shape == (num_methods, 2)
+            np.testing.assert_allclose(pdist(coords), pdist(points))
+            np.testing.assert_allclose(coords.mean(axis=0), 0, atol=1e-12)
+            np.testing.assert_array_equal(self.cns.calculate_coords(mean_distances), coords)
+
+    def test_calculate_coords_sklearn(self):
+        num_methods = 21
+        rng = np.random.default_rng(0)
+        weights = [rng.normal(size=(10, 3)) for _ in range(num_methods)]
+        methods = [str(i) for i in range(num_methods)]
+        _, mean_distances = self.cns.calculate_all_distances(methods, weights)
+
+        with patch.object(MDS, "fit_transform", autospec=True,
+                          side_effect=MDS.fit_transform) as fit_transform:
+            coords = self.cns.calculate_coords(mean_distances)
+
+        fit_transform.assert_called_once()
+        assert coords.shape == (num_methods, 2)
+
+    def test_plot_examples(self):
+        def select_features(contrib_1, contrib_2, max_features):
+            idx = np.flip(np.abs(np.concatenate([contrib_1, contrib_2])).argsort(kind="stable"))
+            idx = idx % len(contrib_1)
+            _, first_occurrence_idx = np.unique(idx, return_index=True)
+            idx = idx[np.sort(first_occurrence_idx)][:max_features]
+            contrib_1, contrib_2 = contrib_1[idx], contrib_2[idx]
+            idx = np.flip(contrib_1.argsort(kind="stable"))
+            return contrib_1[idx], contrib_2[idx]
+
+        # Ties on the absolute contributions, across and within methods
+        method_1 = [np.array([0.5, -0.5, 0.1, 0.5, 0.3]),
+                    np.array([0.2, 0.2, 0.2, 0.2, 0.2]),
+                    np.array([-0.1, 0.4, 0.1, -0.4, 0.0])]
+        method_2 = [np.array([0.1, 0.5, -0.5, 0.3, 0.5]),
+                    np.array([-0.2, 0.2, 0.4, 0.1, -0.4]),
+                    np.array([0.1, -0.1, 0.4, 0.2, 0.4])]
+
+        for max_features in [2, 3, 20]:
+            fig = self.cns.plot_examples(method_1, method_2, [0.1, 0.2, 0.3], [0, 1, 2],
+                                         ["shap"] * 3, ["acv"] * 3, max_features)
+
+            for ax, contrib_1, contrib_2 in zip(fig.axes, method_1, method_2):
+                expected_1, expected_2 = select_features(contrib_1, contrib_2, max_features)
+                num_features = len(expected_1)
+                bars_1, bars_2 = ax.patches[:num_features], ax.patches[num_features:]
+                assert len(bars_2) == num_features
+                np.testing.assert_allclose([bar.get_width() for bar in bars_1], expected_1)
+                np.testing.assert_allclose([bar.get_width() for bar in bars_2], expected_2)
+                offset = np.abs(expected_1.max()) + np.abs(expected_2.min()) + expected_1.max() / 3
+                np.testing.assert_allclose([bar.get_x() for bar in bars_2], offset)
+
     def test_pairwise_consistency_plot(self):
         methods = ["shap", "lime"]
         max_features = 2